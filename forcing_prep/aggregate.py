@@ -9,49 +9,69 @@
     -------
 """
 
+import numba
 import numpy as np
 import xarray as xr
 
 
-def window_aggregate(dataset, coverage):
+@numba.njit(cache=True)
+def _weighted_mean(block, indptr, indices, weights, out):
     """
-    For each coverage window defined in coverage, grab the
-    data from dataset for the coverage cells and do a weighted
-    average for all times in the dataset.
+    Weighted mean of the block cells in each CSR window. Serial, dask already
+    runs one of these per block on each of its threads.
+    block is (variable, time, cell), out is (variable, time, window).
     """
-    all = []
-    windows = coverage.groupby("divide_id")
-    ids = coverage.index.unique().sort_values()
+    nvar = block.shape[0]
+    ntime = block.shape[1]
+    for d in range(len(indptr) - 1):
+        s0 = indptr[d]
+        s1 = indptr[d + 1]
+        wsum = 0.0
+        for k in range(s0, s1):
+            wsum += weights[k]
+        for v in range(nvar):
+            for t in range(ntime):
+                acc = 0.0
+                for k in range(s0, s1):
+                    acc += weights[k] * block[v, t, indices[k]]
+                out[v, t, d] = acc / wsum
 
-    for id in ids:
-        window = windows.get_group(id)
-        cov = window["coverage"]
-        index = (window["global_idx_y"], window["global_idx_x"])
-        # get the raw numpy data for window cells
-        sub = dataset.values[:, :, index[0], index[1]]
-        # perform the aggregation, axis 2 is time
-        # axis 1 is variable
-        data = np.sum(sub * cov.values, axis=2) / cov.sum()
-        # create the dataarray to hold this aggregated data in
-        # with the window id as a dim/coord
-        da = xr.DataArray(
-            data[:, :, np.newaxis],  # add a new axis for the divide_id
-            dims=[
-                "variable",
-                "time",
-                "divide_id",
-            ],
-            coords={
-                "time": dataset.coords["time"],
-                "variable": dataset["variable"].values,
-                "divide_id": [id],
-            },
-        )
-        # TODO don't append, lists get really large and may be leaking mem??
-        # can allocate and define the final datarray upfront and just dump into it...
-        all.append(da)
 
-    ret = xr.concat(all, dim="divide_id")
+def window_aggregate(dataset, csr):
+    """
+    For each coverage window defined in the csr arrays (see weights.get_csr_cov),
+    grab the data from dataset for the coverage cells and do a weighted
+    average for all times in the dataset.
+
+    The windows are spatial (the cells under each divide), every time step
+    is kept at the native resolution of the dataset, nothing is summed
+    through time.
+    """
+    values = dataset.values
+    # flatten the spatial dims so the csr indices address the cells directly,
+    # axis 0 is variable, axis 1 is time
+    block = np.ascontiguousarray(values.reshape(values.shape[0], values.shape[1], -1))
+    # The kernel doesn't bounds check, make sure the weights were built for this extent
+    if len(csr["indices"]) and csr["indices"].max() >= block.shape[2]:
+        raise IndexError(
+            f"Coverage cell index {csr['indices'].max()} is outside of the {block.shape[2]} cell block"
+        )
+    # the kernel accumulates in float64, only the stored means are float32
+    out = np.empty((block.shape[0], block.shape[1], len(csr["ids"])), dtype=np.float32)
+    _weighted_mean(block, csr["indptr"], csr["indices"], csr["weights"], out)
+    ret = xr.DataArray(
+        out,
+        dims=[
+            "variable",
+            "time",
+            "divide_id",
+        ],
+        coords={
+            "time": dataset.coords["time"],
+            "variable": dataset["variable"].values,
+            "divide_id": csr["ids"],
+        },
+    )
     # Try to get rid of the data we don't need anymore, not sure this is
     # actually helping the memory pressure through
     del dataset
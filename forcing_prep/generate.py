@@ -5,8 +5,12 @@ Entrypoint for resampling zarr based AORC to hy_features catchments.
     Saves to file the following outputs:
     - Individual subcatchment forcing timeseries saved as f'{out_dir}/{year_str}/camels_{basin_id}_{year_str}/cat-{subcatchment_id}}.csv'
         where year_str = {year_begin}_to_{year_end}, e.g. '1979_to_2023'
+      or, with cat_format: parquet, as a single dataset partitioned by divide_id saved as f'{out_dir}/{year_str}/camels_{basin_id}_{year_str}/{basin_id}_{year_str}.parquet'
     - Aggregated basin forcing timeseries saved as f'{out_dir}/{year_str}/camels_{basin_id}_{year_str}/{basin_id}_{year_str}_agg.csv'
+    - With zarr_store: true, sub-catchment forcing of all basins is instead saved in a single store f'{out_dir}/{year_str}/forcings.zarr'
     - Basin AORC coverage weightings saved as f'{out_dir}/{year_str}/{basin_id}_{year_str}_coverage.parquet'
+    - With grid_template: true, the vectorized AORC grid cells saved as f'{out_dir}/grid_template.parquet'
+    - With aorc_refs: true, kerchunk references to the yearly AORC stores saved as f'{out_dir}/{year_str}/aorc_refs.json'
 
     Authors
     -------
@@ -22,20 +26,31 @@ Entrypoint for resampling zarr based AORC to hy_features catchments.
     python /path/to/git/CIROH_DL_NextGen/forcing_prep/generate.py "/path/to/git/CIROH_DL_NextGen/forcing_prep/config_aorc.yaml"
 """
 import argparse
+import fcntl
+import json
+import multiprocessing
+import os
 import yaml
-from multiprocessing.pool import ThreadPool
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
 
 import dask
 import dask.delayed
+import fsspec
 import geopandas as gpd
 import numpy as np
 import s3fs
 import xarray as xr
+from dask.distributed import Client
+from dask.utils import parse_bytes
+from distributed.system import MEMORY_LIMIT
 
 from geo_proc import process_geo_data
+from weights import build_grid_template
 
-dask.config.set(pool=ThreadPool(12))
+# Keep dask worker memory bounded, spilling to disk well before the limit
+dask.config.set({"distributed.worker.memory.target": 0.6, "distributed.worker.memory.spill": 0.75})
 
 import dask.dataframe as ddf
 
@@ -53,7 +68,16 @@ def to_ngen_netcdf(ds: xr.Dataset, out_dir: Path, uniq_name: str) -> None:
         # TODO put in feature request for ngen to handle proper cf time units
         # ds['Time'].attrs['epoch_start'] = "01/01/1970 00:00:00"
         # ds['Time'].attrs['units'] = "seconds"
-        ds.to_netcdf(path / f"{uniq_name}.nc")
+        # float32 keeps ~7 significant digits, more than the ~5 AORC carries
+        ds = ds.astype({v: "float32" for v in ds.data_vars})
+        # Chunk along both dims and compress, the forcing fields are smooth
+        # so shuffle + zlib shrinks them a lot at little cost
+        chunksizes = (min(256, ds.sizes['catchment-id']), min(8760, ds.sizes['time']))
+        encoding = {
+            v: {"chunksizes": chunksizes, "zlib": True, "complevel": 3, "shuffle": True}
+            for v in ds.data_vars
+        }
+        ds.to_netcdf(path / f"{uniq_name}.nc", encoding=encoding)
         # Not sure this is going to work quite as well
         # since ngen expects an id dimension in netcdf
         # it is much easier to "fake" forcing to ngen using csv...
@@ -61,35 +85,198 @@ def to_ngen_netcdf(ds: xr.Dataset, out_dir: Path, uniq_name: str) -> None:
         # ds.to_netcdf(path / f"{uniq_name}_agg.csv")
         return
 
-def generate_forcing(gdf: gpd.GeoDataFrame, kwargs: dict) -> None:
-    
+def to_zarr_store(ds: xr.Dataset, store: Path) -> None:
+    """
+    Append a basin's forcing to a single zarr store shared by every basin, growing
+    along divide_id. Appends are serialized through a lock file so concurrent basin
+    workers can share the store. Divides already in the store (e.g. from a nested
+    basin or an interrupted run) are not written again.
+    """
+    # Variable length strings, so longer ids from later basins aren't truncated
+    ds = ds.assign_coords(divide_id=ds['divide_id'].astype(object))
+    ds = ds.transpose('divide_id', 'time')
+    with open(f"{store}.lock", 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if store.exists():
+            existing = xr.open_zarr(store)['divide_id'].values
+            ds = ds.sel(divide_id=~ds['divide_id'].isin(existing))
+            if ds.sizes['divide_id'] == 0:
+                return
+            ds.to_zarr(store, mode="a", append_dim="divide_id")
+        else:
+            chunks = (256, min(8760, ds.sizes['time']))
+            encoding = {v: {"chunks": chunks} for v in ds.data_vars}
+            ds.to_zarr(store, mode="w-", encoding=encoding)
+
+def generate_forcing(gdf: gpd.GeoDataFrame, forcing: xr.Dataset, kwargs: dict) -> None:
+    # Work on a copy, the same config is shared by every basin
+    kwargs = dict(kwargs)
     year_str = kwargs.pop('year_str')
     name = kwargs.pop('name')
     out_dir = kwargs.get('out_dir', './')
     nc_out = kwargs.pop('netcdf', True)
+    cat_format = kwargs.pop('cat_format', 'csv')
+    zarr_store = kwargs.pop('zarr_store', None)
     uniq_name = f'{name}_{year_str}'
 
-    df = process_geo_data(gdf, forcing, name, **kwargs)
+    ds = process_geo_data(gdf, forcing, name, **kwargs)
+    if zarr_store is not None:
+        to_zarr_store(ds, zarr_store)
+        path = out_dir
     # save to netcdf is requested
-    if nc_out:
-        to_ngen_netcdf(df, out_dir, uniq_name)
+    elif nc_out:
+        to_ngen_netcdf(ds, out_dir, uniq_name)
         path = out_dir
     else:
-        df = df.to_dataframe()
-            
-        cats = df.groupby("divide_id")
+        # Materialize the frame once, ordered by sub-catchment so each one's
+        # rows are already contiguous and sorted (divide_id is sorted in ds)
+        df = ds.to_dataframe(dim_order=["divide_id", "time"])
         path = Path(f"{out_dir}/camels_{uniq_name}")
         Path.mkdir(path, exist_ok=True)
-        # Write timeseries for each sub-catchment within CAMELS basin
-        for name, data in cats:
-            data = data.droplevel('divide_id')
-            data.to_csv(path / f"{name}_{uniq_name}.csv")
+        if cat_format == 'parquet':
+            # Single dataset partitioned by sub-catchment, avoids writing
+            # thousands of small csv files one at a time
+            df.reset_index().to_parquet(
+                path / f"{uniq_name}.parquet",
+                partition_cols=["divide_id"],
+                engine="pyarrow",
+                compression="zstd",
+            )
+        else:
+            # Write timeseries for each sub-catchment within CAMELS basin.
+            # One partition per sub-catchment lets dask format the csv files
+            # in parallel across its workers.
+            cats = df.reset_index(level="time")
+            divide_ids = cats.index.unique().tolist()
+            cats = ddf.from_pandas(cats, npartitions=1).repartition(
+                divisions=divide_ids + [divide_ids[-1]]
+            )
+            cats.to_csv(
+                str(path / f"*_{uniq_name}.csv"),
+                name_function=lambda i: divide_ids[i],
+                index=False,
+                compute=True,
+            )
     # Write aggregated basin timeseries (all subcatchments averaged together)
     # See comment at end of to_ngen_netcdf for why this is still done in csv for now
-    df = df.to_dataframe()
-    agg = df.groupby("time").mean()
+    # Reduce on the arrays before going to pandas, the result is only time x variable
+    agg = ds.mean(dim="divide_id").to_dataframe()
     agg.to_csv(path / f"{uniq_name}_agg.csv")
 
+def build_forcing_refs(aorc_source: str, aorc_year_url: str, years: tuple, refs_path: Path) -> None:
+    """Combine the yearly AORC zarr stores along time into a single kerchunk reference file"""
+    # Only needed with aorc_refs, and keeps to_ngen_netcdf importable without kerchunk
+    from kerchunk.combine import MultiZarrToZarr
+    from kerchunk.zarr import single_zarr
+    singles = [
+        single_zarr(aorc_year_url.format(source=aorc_source, year=year), storage_options={"anon": True})
+        for year in range(*years)
+    ]
+    refs = MultiZarrToZarr(
+        singles,
+        concat_dims=["time"],
+        remote_protocol="s3",
+        remote_options={"anon": True},
+    ).translate()
+    with open(refs_path, 'w') as file:
+        json.dump(refs, file)
+
+def read_divides(src, proj) -> gpd.GeoDataFrame:
+    """
+    Read the divides layer of a hydrofabric geopackage in the forcing projection.
+    pyogrio reads the layer in bulk through GDAL, and only the id column is kept.
+    """
+    return gpd.read_file(
+        src, layer="divides", engine="pyogrio", columns=["divide_id"], use_arrow=True
+    ).to_crs(proj)
+
+def open_forcing(aorc_source: str, aorc_year_url: str, years: tuple, s3: s3fs.S3FileSystem, refs: Path = None, ctime: int = None) -> xr.Dataset:
+    """
+    Lazily open the yearly AORC zarr stores as a single dataset, through the
+    kerchunk references from build_forcing_refs if given. The stores' own
+    chunking is kept, except through time when ctime (a multiple of the
+    stored time chunk, see aligned_time_chunk) is given.
+    """
+    chunks = {"time": ctime} if ctime is not None else {}
+    if refs is not None:
+        fs = fsspec.filesystem(
+            "reference", fo=str(refs), remote_protocol="s3", remote_options={"anon": True}
+        )
+        return xr.open_dataset(fs.get_mapper(""), engine="zarr", consolidated=False, chunks=chunks)
+    files = [
+        s3fs.S3Map(
+            root=aorc_year_url.format(source=aorc_source, year=year),
+            s3=s3,
+            check=False,
+        )
+        for year in range(*years)
+    ]
+    return xr.open_mfdataset(files, engine="zarr", parallel=True, consolidated=True, chunks=chunks)
+
+def aligned_time_chunk(forcing: xr.Dataset, ctime_max: int) -> int:
+    """
+    The largest multiple of the stored time chunk that is at most ctime_max, so
+    every dask chunk covers whole stored chunks. None if the stored chunk is
+    unknown or already bigger than ctime_max.
+    """
+    encoding = forcing[next(iter(forcing.keys()))].encoding
+    stored = encoding.get("preferred_chunks", {}).get("time")
+    if not stored or stored > ctime_max:
+        return None
+    return (ctime_max // stored) * stored
+
+# Per-process state, populated by _init_process
+_proc = {}
+
+def _init_process(aorc_source: str, aorc_year_url: str, years: tuple, n_threads: int, memory_limit: str = "4GB", refs: Path = None, ctime: int = None, n_workers: int = None, n_procs: int = 1) -> None:
+    """
+    Start a local dask cluster using n_threads and open the forcing for this process.
+    zarr/s3fs handles are not safe to share across processes, so each
+    basin worker re-opens its own. No cluster is started if n_threads is 0.
+    The n_procs processes doing this at once share the machine's memory.
+    """
+    if n_threads > 0:
+        # By default two threads per worker process, so S3 reads overlap with
+        # the aggregation without everything contending for one GIL
+        n_workers = n_workers or max(1, n_threads // 2)
+        # Don't hand the workers more memory than this process's share of the
+        # machine, MEMORY_LIMIT also honours cgroup limits (e.g. under slurm)
+        memory_limit = min(parse_bytes(memory_limit), MEMORY_LIMIT // (n_procs * n_workers))
+        _proc['client'] = Client(
+            n_workers=n_workers,
+            threads_per_worker=max(1, n_threads // n_workers),
+            memory_limit=memory_limit,
+        )
+        # Only persist basin tiles that fit in a quarter of the cluster memory,
+        # workers are paused at 80% of their limit and restarted at 95%
+        workers = _proc['client'].scheduler_info()['workers'].values()
+        _proc['persist_gb'] = 0.25 * sum(w['memory_limit'] for w in workers) / 1e9
+    s3 = s3fs.S3FileSystem(anon=True)
+    forcing = open_forcing(aorc_source, aorc_year_url, years, s3, refs=refs, ctime=ctime)
+    _proc['s3'] = s3
+    _proc['forcing'] = forcing
+    _proc['proj'] = forcing[next(iter(forcing.keys()))].crs
+
+def _log_status(log_file: Path, basin_id: str, status: str) -> None:
+    """Append a basin status line, locking so concurrent workers don't interleave"""
+    with open(log_file, 'a') as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        file.write(f"{basin_id}: {status}\n")
+
+def _run_basin(b: str, config: dict, basin_url: str, log_file: Path) -> None:
+    """Generate the forcing for a single CAMELS basin"""
+    # Add basin to the log file with status 'processing'
+    _log_status(log_file, b, "processing")
+
+    # read the geopackage from s3
+    gdf = read_divides(_proc['s3'].open(basin_url.format(basin_id=b)), _proc['proj'])
+    config = dict(config, name=b)
+    config.setdefault('persist_gb', _proc['persist_gb'])
+    generate_forcing(gdf, _proc['forcing'], config)
+
+    # Update the log file with status 'finished'
+    _log_status(log_file, b, "finished")
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Process the YAML config file.')
@@ -115,6 +302,12 @@ if __name__ == "__main__":
     x_lon_dim = config['x_lon_dim']
     y_lat_dim = config['y_lat_dim']
     out_dir = Path(config['out_dir'].format(home_dir=str(Path.home())))
+    basin_workers = config.pop('basin_workers', 1)
+    grid_template = config.pop('grid_template', False)
+    aorc_refs = config.pop('aorc_refs', False)
+    memory_limit = config.pop('dask_memory_limit', "4GB")
+    dask_workers = config.pop('dask_workers', None)
+    zarr_store = config.pop('zarr_store', False)
 
     # Setup the s3fs filesystem that is going to be used by xarray to open the zarr files
     _s3 = s3fs.S3FileSystem(anon=True)
@@ -133,6 +326,8 @@ if __name__ == "__main__":
     out_dir = Path(out_dir/f'{year_str}')
     config['out_dir'] = out_dir
     config['year_str'] = year_str
+    if zarr_store:
+        config['zarr_store'] = out_dir / "forcings.zarr"
     # TODO add search for existing years and only fill in those which are missing
 
     # Create output directory in case it does not exist
@@ -140,55 +335,71 @@ if __name__ == "__main__":
         print("Creating the following path for writing output: " + str(out_dir))
         Path.mkdir(out_dir, exist_ok = True, parents = True)
 
-    files = [
-        s3fs.S3Map(
-            root=_aorc_year_url.format(source=_aorc_source, year=year),
-            s3=_s3,
-            check=False,
-        )
-        for year in range(*years) 
-    ] 
-
-    forcing = xr.open_mfdataset(files, engine="zarr", parallel=True, consolidated=True)
-
-    proj = forcing[next(iter(forcing.keys()))].crs
+    refs = None
+    if aorc_refs:
+        # Index every year's store once so they open as a single zarr
+        refs = out_dir / "aorc_refs.json"
+        if not refs.exists():
+            print(f"Building AORC kerchunk references {refs}")
+            build_forcing_refs(_aorc_source, _aorc_year_url, years, refs)
+    # With a process pool each basin worker starts its own cluster, so there
+    # is no need for one here
+    # Only count the cores this process may run on (e.g. under slurm or taskset)
+    n_cores = len(os.sched_getaffinity(0))
+    n_threads = n_cores if gpkg is not None or basin_workers == 1 else 0
+    _init_process(_aorc_source, _aorc_year_url, years, n_threads, memory_limit, refs=refs, n_workers=dask_workers)
+    # Chunk through time in whole multiples of the stored chunks, and have
+    # process_geo_data use the same size so it doesn't need to rechunk through
+    # time. Otherwise chunks straddling two stored chunks would read them twice,
+    # so keep the stored chunking and let process_geo_data rechunk.
+    ctime = aligned_time_chunk(_proc['forcing'], ctime_max)
+    if ctime is not None:
+        config['ctime_max'] = ctime
+        _proc['forcing'] = _proc['forcing'].chunk({"time": ctime})
+    proj = _proc['proj']
     print(proj)
+
+    if grid_template:
+        # The grid is the same for every basin and year, so vectorize it once
+        grid_path = out_dir.parent / "grid_template.parquet"
+        if not grid_path.exists():
+            print(f"Building grid template {grid_path}")
+            build_grid_template(_proc['forcing'], y_lat_dim, x_lon_dim, proj, grid_path)
+        config['grid_template'] = str(grid_path)
     
     # Ensure the processing log file exists
     log_file = Path(out_dir) / "processing_log.txt"
     if not log_file.exists():
         log_file.touch()
+    # Read the log once, basins that finished in a previous run are skipped
+    done = {
+        line.split(':')[0]
+        for line in log_file.read_text().splitlines()
+        if line.endswith(': finished')
+    }
+    if gpkg is None:
+        for b in basins:
+            if str(b) in done:
+                print(f"Basin {b} already processed. Skipping.")
+        basins = [b for b in basins if str(b) not in done]
 
     if gpkg is not None:
-        gdf = gpd.read_file(gpkg, driver="gpkg", layer="divides").to_crs(proj)
+        gdf = read_divides(gpkg, proj)
         config['name'] = gpkg.stem
-        generate_forcing(gdf, config)
+        config.setdefault('persist_gb', _proc['persist_gb'])
+        generate_forcing(gdf, _proc['forcing'], config)
+    elif basin_workers > 1:
+        # Basins are independent, so farm them out to separate processes.
+        # Split the cores between them so the per-process dask clusters
+        # don't oversubscribe the machine.
+        n_threads = max(1, n_cores // basin_workers)
+        with ProcessPoolExecutor(
+            max_workers=basin_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_process,
+            initargs=(_aorc_source, _aorc_year_url, years, n_threads, memory_limit, refs, ctime, dask_workers, basin_workers),
+        ) as ex:
+            list(ex.map(_run_basin, basins, repeat(config), repeat(_basin_url), repeat(log_file)))
     else:
         for b in basins:
-            
-            # Read the processing log file
-            with open(log_file, 'r') as file:
-                processed_basins = file.read().splitlines()
-            
-            if b in [line.split(':')[0] for line in processed_basins]:
-                print(f"Basin {b} already processed. Skipping.")
-                continue
-
-            # Add basin to the log file with status 'processing'
-            with open(log_file, 'a') as file:
-                file.write(f"{b}: processing\n")
-
-            # This is a bug, this line should be unneccessary, but this is the simple fix I could fine.
-            config['year_str'] = year_str
-
-            # read the geopackage from s3
-            gdf = gpd.read_file(
-                _s3.open(_basin_url.format(basin_id=b)), driver="gpkg", layer="divides"
-            ).to_crs(proj)
-            config['name'] = b
-            generate_forcing(gdf, config)
-            
-            # Update the log file with status 'finished'
-            with open(log_file, 'a') as file:
-                file.write(f"{b}: finished\n")
-
+            _run_basin(b, config, _basin_url, log_file)
@@ -10,6 +10,15 @@
     2024-May: Originally created, NF
     2024-06-18: Minor adaptations to flipped dataset check, data selection, NF, GL
     2024-06-27: Expand slicing dimension coverage if first attempt at computing weights fails, GL
+    2026-10-15: Write coverage parquet in Hilbert order with per row group bbox statistics
+    2026-10-15: Optionally compute weights from a cached grid template
+    2026-10-15: Pass CSR coverage arrays to the numba aggregation kernel
+    2026-10-15: Cache the CSR coverage arrays as npz next to the coverage parquet
+    2026-10-15: Build weight_raster from the already sliced data, only load it for exact extract
+    2026-10-15: Aggregate into float32 outputs
+    2026-10-15: Persist the sliced raster before aggregating when it fits in persist_gb
+    2026-10-15: Build the map_blocks template lazily with dask
+    2026-10-15: Show progress under a dask.distributed client too
 '''
 
 
@@ -18,18 +27,36 @@ from pathlib import Path
 from multiprocessing.pool import ThreadPool
 
 import dask
+import dask.array as da
 import dask.delayed
 import geopandas as gpd
 import numpy as np
 import s3fs
 import xarray as xr
 from dask.diagnostics import ProgressBar
+from dask.distributed import get_client, progress
 import dask.dataframe as ddf
 
 from aggregate import window_aggregate
-from weights import get_all_cov, get_weights_df
+from weights import (
+    get_all_cov,
+    get_csr_cov,
+    get_weights_df,
+    get_weights_df_from_template,
+    load_csr_cov,
+    save_csr_cov,
+    write_cov_parquet,
+)
 
-def process_geo_data(gdf, data, name, y_lat_dim, x_lon_dim, id_col = 'divide_id', out_dir = '', redo = False, cvar = 8, ctime_max = 120, cid = -1):
+def _get_weights(gdf, raster, y_lat_dim, x_lon_dim, id_col, grid_template):
+    """Compute weights with exact extract, or from the cached grid template if one is given"""
+    if grid_template is None:
+        return get_weights_df(gdf, raster.compute(), id_col=id_col)
+    # Only the raster coordinates are needed here, so it never gets loaded
+    grid = gpd.read_parquet(grid_template, bbox=tuple(gdf.total_bounds))
+    return get_weights_df_from_template(gdf, grid, raster, y_lat_dim, x_lon_dim, id_col=id_col)
+
+def process_geo_data(gdf, data, name, y_lat_dim, x_lon_dim, id_col = 'divide_id', out_dir = '', redo = False, cvar = 8, ctime_max = 120, cid = -1, grid_template = None, persist_gb = 4):
     '''
    Given a geodataframe representing catchment(s) boundaries and a raster dataset,
     compute the mean data values spanning the catchment(s) boundaries.
@@ -56,6 +83,12 @@ def process_geo_data(gdf, data, name, y_lat_dim, x_lon_dim, id_col = 'divide_id'
         The max chunk time frame. Units of hours. Default is 120.
     cid : int, optional
         The `id_col` chunk size. Default is -1, which means all divide_ids in a basin. A small value may be needed for very large basins with many catchments.
+    grid_template : str, optional
+        Path to a grid template GeoParquet from `weights.build_grid_template`. When given, weights are
+        computed from the cached grid cells instead of exact extract. Default is None.
+    persist_gb : float, optional
+        The sliced raster data is loaded into memory once before aggregating when it is at most this
+        many GB, so the data isn't fetched again if the graph gets recomputed. Default is 4.
 
     Returns
     -------
@@ -73,47 +106,73 @@ def process_geo_data(gdf, data, name, y_lat_dim, x_lon_dim, id_col = 'divide_id'
         # in order for xarray to use slice indexing, need to ensure
         # the lats slice is high to low when the latitude index is reversed
         lats = slice(extent[3], extent[1])
+    x_lon_diff = data[x_lon_dim][1].values - data[x_lon_dim][0].values
+    y_lat_diff = data[y_lat_dim][1].values - data[y_lat_dim][0].values
+    if grid_template is not None:
+        # Slicing selects on cell centres, but the grid template weights every
+        # cell intersecting a feature, including the ones whose centre is up
+        # to half a cell outside the bounds, so pad the domain by that much
+        hx = abs(x_lon_diff) / 2
+        hy = abs(y_lat_diff) / 2
+        lons = slice(extent[0]-hx, extent[2]+hx)
+        lats = slice(extent[3]+hy, extent[1]-hy) if flipped else slice(extent[1]-hy, extent[3]+hy)
     data_sub = data.sel(indexers = {x_lon_dim:lons, y_lat_dim:lats})
+    # The domain expanded by a cell on each side, used when the weights need
+    # more coverage than data_sub has (slicing is lazy, nothing is read here)
+    if flipped:
+        lats_big = slice(extent[3]-y_lat_diff, extent[1]+y_lat_diff)
+    else:
+        lats_big = slice(extent[1]-y_lat_diff, extent[3]+y_lat_diff)
+    lons_big = slice(extent[0]-x_lon_diff, extent[2]+x_lon_diff)
+    biggerdata = data.sel(indexers = {x_lon_dim:lons_big, y_lat_dim:lats_big})
     # Load or compute coverage masks
     save = Path(f"{out_dir}/{name}_coverage.parquet")
-    if save.exists() and redo != True:
+    # The flattened arrays the aggregation kernel reads are cached alongside
+    save_csr = save.with_suffix(".npz")
+    csr = None
+    if save_csr.exists() and redo != True:
+        print(f"Reading {name} coverage arrays from file")
+        csr = load_csr_cov(save_csr)
+        # The cell indices are raveled on the extent the weights were built on,
+        # which may have been the expanded one
+        shape = tuple(csr["shape"])
+        if shape == (data_sub[y_lat_dim].size, data_sub[x_lon_dim].size):
+            data = data_sub
+        elif shape == (biggerdata[y_lat_dim].size, biggerdata[x_lon_dim].size):
+            data = biggerdata
+        else:
+            raise ValueError(
+                f"Cached coverage {save_csr} was built on a {shape} raster which doesn't match the domain, "
+                "rerun with redo set to true"
+            )
+    elif save.exists() and redo != True:
         print(f"Reading {name} coverage from file")
-        coverage = ddf.read_parquet(save).compute()
+        coverage = ddf.read_parquet(
+            save, columns=["ids", "coverage", "global_idx_y", "global_idx_x"]
+        ).compute()
         data = data_sub
         #NJF FIXME this isn't quite right if coverage is created based on biggerdata below?????
     else:
         # If we don't have weights cached, compute and save them
-        weight_raster = (
-            data_sub[next(iter(data_sub.keys()))]
-            .isel(time=0)
-            .sel(indexers = {x_lon_dim:lons, y_lat_dim:lats})
-            .compute()
-        )
+        # data_sub is already sliced to the domain, and the raster is only
+        # loaded if the weights need its values
+        weight_raster = data_sub[next(iter(data_sub.keys()))].isel(time=0)
         print("Computing Weights")
         try:
-            weights_df = get_weights_df(gdf, weight_raster, id_col=id_col)
+            weights_df = _get_weights(gdf, weight_raster, y_lat_dim, x_lon_dim, id_col, grid_template)
             data = data_sub
         except:
             print('weight_raster may not have enough coverage. Try expanding size of sliced raster')
-            x_lon_diff = data[x_lon_dim][1].values - data[x_lon_dim][0].values
-            y_lat_diff = data[y_lat_dim][1].values - data[y_lat_dim][0].values
-            if flipped:
-                lats_big = slice(extent[3]-y_lat_diff, extent[1]+y_lat_diff)
-            else:
-                lats_big = slice(extent[1]-y_lat_diff, extent[3]+y_lat_diff)
-            lons_big = slice(extent[0]-x_lon_diff, extent[2]+x_lon_diff)
-            biggerdata = data.sel(indexers = {x_lon_dim:lons_big, y_lat_dim:lats_big})
-            weight_raster = (
-                biggerdata[next(iter(biggerdata.keys()))]
-                .isel(time=0)
-                .sel(indexers = {x_lon_dim:lons_big, y_lat_dim:lats_big})
-                .compute()
-            )
-            weights_df = get_weights_df(gdf, weight_raster,id_col=id_col)
+            weight_raster = biggerdata[next(iter(biggerdata.keys()))].isel(time=0)
+            weights_df = _get_weights(gdf, weight_raster, y_lat_dim, x_lon_dim, id_col, grid_template)
             data = biggerdata
         print("Creating Coverage")
         coverage = get_all_cov(data, weights_df, y_lat_dim = y_lat_dim, x_lon_dim = x_lon_dim)
-        coverage.to_parquet(save)
+        write_cov_parquet(coverage, gdf, save, id_col=id_col)
+    if csr is None:
+        # Flatten the coverage once up front for the aggregation kernel
+        csr = get_csr_cov(coverage, (data[y_lat_dim].size, data[x_lon_dim].size))
+        save_csr_cov(csr, save_csr)
     print("Processing the following raster data set")
     #print(data)
     # Stack all the raster variables into a single multi-dimension array
@@ -136,6 +195,11 @@ def process_geo_data(gdf, data, name, y_lat_dim, x_lon_dim, id_col = 'divide_id'
     data = data.chunk(
         {"variable": cvar, y_lat_dim: -1, x_lon_dim: -1, "time": ctime}
     )
+    # Fetch the domain tile once up front if it comfortably fits in memory,
+    # otherwise it's streamed from the source as the aggregation runs
+    print(f"Raster data for {name} is {data.nbytes / 1e9:.2f} GB")
+    if data.nbytes <= persist_gb * 1e9:
+        data = data.persist()
     # Build the template data array for the outputs
     coords = {
         "time": data.time,
@@ -148,14 +212,34 @@ def process_geo_data(gdf, data, name, y_lat_dim, x_lon_dim, id_col = 'divide_id'
         data.time.size,
         len(gdf[id_col]),
     )
-    var = xr.DataArray(np.zeros(shp), coords=coords, dims=dims)
+    # The template is only used for its metadata, so build it lazily rather
+    # than allocating the full output in memory.
+    # AORC carries ~5 significant digits, float32 is plenty for the outputs
     # It is important to make sure these chunks align with the data chunks!
-    var = var.chunk({"variable": cvar, "time": ctime, "divide_id": cid})
-    result = data.map_blocks(window_aggregate, args=(coverage,), template=var)
+    var = xr.DataArray(
+        da.zeros(shp, chunks=(cvar, ctime, cid), dtype=np.float32),
+        coords=coords,
+        dims=dims,
+    )
+    result = data.map_blocks(window_aggregate, args=(csr,), template=var)
+    # The graph keeps its own reference, release ours so the persisted
+    # tile can be freed as soon as the result is computed
+    del data
     # Perform the computations
+    try:
+        client = get_client()
+    except ValueError:
+        client = None
+    # ProgressBar only reports for the local schedulers, under a distributed
+    # client the progress comes from the futures instead
     with ProgressBar():
         try:
-            result = result.compute()
+            if client is None:
+                result = result.compute()
+            else:
+                result = result.persist()
+                progress(result)
+                result = result.compute()
         except:
             print("TODO: is there a dimensional out of bounds problem? Try and figure this out")
             # print("Attempting without chunking/window aggregation")
@@ -16,6 +16,9 @@ import dask.dataframe as ddf
 import geopandas as gpd
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
 import xarray as xr
 from exactextract import exact_extract
 
@@ -34,6 +37,28 @@ def get_weights_df(gdf: gpd.GeoDataFrame, raster: xr.DataArray,id_col:str = 'div
         output="pandas",
     )
     output.set_index(id_col, inplace=True)
+    output = _fill_missing(output, gdf, id_col)
+
+    # turns out this wasn't problem, but could be at some point...
+    # TODO test exact extract's behavoir on features on the edge of the
+    # raster domain...
+    # clipped = gdf[ gdf['divide_id'].isin(missing['divide_id']) ]
+    # rb = raster.rio.bounds()
+    # clipped.loc[:,'geometry'] = clipped['geometry'].clip_by_rect(*rb)
+    # clipped = exact_extract(
+    #     raster,
+    #     clipped,
+    #     stats,
+    #     include_cols=["divide_id"],
+    #     output="pandas",
+    # )
+    # print(clipped)
+
+    return output
+
+
+def _fill_missing(output: pd.DataFrame, gdf: gpd.GeoDataFrame, id_col: str = 'divide_id') -> pd.DataFrame:
+    """Give features without any coverage the weights of their nearest neighbor"""
     # Some features may have no coverage, in that case warn the user
     # and for now just do a nearest neighbor assignment so they have
     # SOME data...
@@ -50,23 +75,79 @@ def get_weights_df(gdf: gpd.GeoDataFrame, raster: xr.DataArray,id_col:str = 'div
         for name, group in mapping:
             copy_from = output.loc[group.iloc[0]["divide_id_left"]]
             output.loc[name] = copy_from
+    return output
 
-    # turns out this wasn't problem, but could be at some point...
-    # TODO test exact extract's behavoir on features on the edge of the
-    # raster domain...
-    # clipped = gdf[ gdf['divide_id'].isin(missing['divide_id']) ]
-    # rb = raster.rio.bounds()
-    # clipped.loc[:,'geometry'] = clipped['geometry'].clip_by_rect(*rb)
-    # clipped = exact_extract(
-    #     raster,
-    #     clipped,
-    #     stats,
-    #     include_cols=["divide_id"],
-    #     output="pandas",
-    # )
-    # print(clipped)
 
-    return output
+def build_grid_template(dataset, y_lat_dim, x_lon_dim, crs, cache_path, row_group_size = 50000) -> gpd.GeoDataFrame:
+    """
+    Vectorize every cell of a regular raster grid into a polygon and cache the
+    result as GeoParquet, Hilbert ordered with a bbox covering column so that
+    a basin's cells can be read back with a bbox filter. This only needs to
+    happen once per grid, the per basin weights then come from
+    get_weights_df_from_template.
+    """
+    x = dataset[x_lon_dim].values
+    y = dataset[y_lat_dim].values
+    # half cell sizes, assumes a regular grid
+    hx = np.abs(x[1] - x[0]) / 2
+    hy = np.abs(y[1] - y[0]) / 2
+    xx, yy = np.meshgrid(x, y)
+    xx = xx.ravel()
+    yy = yy.ravel()
+    grid = gpd.GeoDataFrame(
+        {"x": xx, "y": yy},
+        geometry=shapely.box(xx - hx, yy - hy, xx + hx, yy + hy),
+        crs=crs,
+    )
+    grid = grid.iloc[np.argsort(grid.hilbert_distance().values, kind="stable")]
+    grid.to_parquet(cache_path, write_covering_bbox=True, row_group_size=row_group_size)
+    return grid
+
+
+def get_weights_df_from_template(gdf: gpd.GeoDataFrame, grid: gpd.GeoDataFrame, raster: xr.DataArray, y_lat_dim: str, x_lon_dim: str, id_col: str = 'divide_id') -> pd.DataFrame:
+    """
+    Get the coverage weights of the given raster for each feature from the
+    grid cells of build_grid_template. Returns the same layout as get_weights_df,
+    with cell_id raveled on the extent of raster.
+    """
+    cells = grid.geometry.to_numpy()
+    polys = gdf.geometry.to_numpy()
+    # Bulk query every feature against the cells at once, returns the
+    # (feature, cell) index pairs that intersect
+    feature_idx, cell_idx = shapely.STRtree(cells).query(polys, predicate="intersects")
+    hits = cells[cell_idx]
+    inter = pd.DataFrame(
+        {
+            id_col: gdf[id_col].to_numpy()[feature_idx],
+            "coverage": shapely.area(shapely.intersection(hits, polys[feature_idx])) / shapely.area(hits),
+            "x": grid["x"].to_numpy()[cell_idx],
+            "y": grid["y"].to_numpy()[cell_idx],
+        }
+    )
+    # cells only touching a feature's boundary don't contribute anything
+    inter = inter[inter["coverage"] > 0]
+    # Map the cells back onto the (sliced) raster the data will be read from
+    iy = raster[y_lat_dim].to_index().get_indexer(inter["y"])
+    ix = raster[x_lon_dim].to_index().get_indexer(inter["x"])
+    if (iy < 0).any() or (ix < 0).any():
+        raise ValueError("Features intersect grid cells outside of the raster extent")
+    inter["cell_id"] = np.ravel_multi_index(
+        (iy, ix), (raster[y_lat_dim].size, raster[x_lon_dim].size)
+    )
+    groups = inter.groupby(id_col)
+    output = pd.DataFrame(
+        {
+            "cell_id": groups["cell_id"].apply(np.asarray),
+            "coverage": groups["coverage"].apply(np.asarray),
+        }
+    ).reindex(gdf[id_col])
+    # Features that don't touch any cell come back as NaN, make them empty
+    # so they get picked up as missing
+    for col, dtype in (("cell_id", np.int64), ("coverage", float)):
+        output[col] = output[col].apply(
+            lambda v: v if isinstance(v, np.ndarray) else np.array([], dtype=dtype)
+        )
+    return _fill_missing(output, gdf, id_col)
 
 
 def _build_index(series, global_shape):
@@ -108,3 +189,70 @@ def get_all_cov(dataset, weights_df,y_lat_dim = 'latitude', x_lon_dim = 'longitu
     all = all.compute()
 
     return all
+
+
+def get_csr_cov(coverage, shape):
+    """
+    Flatten a coverage dataframe from get_all_cov into CSR style arrays sorted
+    by divide_id. The cells of the i-th divide are indices[indptr[i]:indptr[i+1]],
+    raveled on shape, with matching weights.
+    """
+    coverage = coverage.sort_index(kind="stable")
+    # Rows are sorted, so the codes run in order and the counts line up with them
+    codes, ids = pd.factorize(coverage.index, sort=True)
+    counts = np.bincount(codes, minlength=len(ids))
+    # Keep the native dtype (e.g. integer hru_id) to match the template coords,
+    # but object arrays (e.g. from arrow backed string indexes) would get
+    # pickled into the npz and can't be loaded back, so make those fixed width
+    ids = np.asarray(ids)
+    if ids.dtype == object:
+        ids = ids.astype(str)
+    indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    indices = np.ravel_multi_index(
+        (coverage["global_idx_y"].values, coverage["global_idx_x"].values), shape
+    )
+    # Keep the arrays contiguous and tight, cells index a basin sized raster
+    # so int32 is plenty and the weights don't need double precision
+    return {
+        "ids": ids,
+        "indptr": indptr,
+        "indices": indices.astype(np.int32),
+        "weights": coverage["coverage"].values.astype(np.float32),
+        "shape": np.asarray(shape, dtype=np.int64),
+    }
+
+
+def save_csr_cov(csr, path):
+    """Cache the arrays from get_csr_cov as an (uncompressed) npz"""
+    np.savez(path, **csr)
+
+
+def load_csr_cov(path):
+    """Load arrays cached with save_csr_cov"""
+    with np.load(path) as npz:
+        return {k: npz[k] for k in npz.files}
+
+
+def write_cov_parquet(coverage, gdf, path, id_col = 'divide_id', row_group_size = 5000):
+    """
+    Write a coverage dataframe from get_all_cov to parquet, ordered along a
+    Hilbert curve over the feature centroids and split into many row groups.
+    The bounding box of each feature is stored as xmin/ymin/xmax/ymax columns
+    so readers can skip row groups outside a region using the column statistics.
+    """
+    features = gdf.set_index(id_col)
+    bbox = features.bounds.rename(
+        columns={"minx": "xmin", "miny": "ymin", "maxx": "xmax", "maxy": "ymax"}
+    )
+    bbox["hilbert"] = features.centroid.hilbert_distance()
+    coverage = coverage.join(bbox)
+    coverage = coverage.sort_values(["hilbert", coverage.index.name], kind="stable")
+    pq.write_table(
+        pa.Table.from_pandas(coverage),
+        path,
+        row_group_size=row_group_size,
+        write_statistics=True,
+        use_dictionary=True,
+        compression="zstd",
+    )